@@ -51,6 +51,15 @@ PG_PORT = os.getenv('PG_PORT')
 PG_DB_NAME = os.getenv('PG_DB_NAME')
 POSTGRES_URI = f"postgresql://{PG_USER}:{PG_PASSWORD}@{PG_HOST}:{PG_PORT}/{PG_DB_NAME}"
 
+# pool de conexiones compartido por todas las consultas del proceso
+PG_POOL_SIZE = 10
+PG_MAX_OVERFLOW = 5
+PG_POOL_RECYCLE = 60*60  # 1 hora en segundos
+# filas por bloque al cargar tablas completas con COPY
+PG_COPY_CHUNK_SIZE = 50000
+# filas por bloque al leer consultas grandes con un cursor del lado del servidor
+PG_STREAM_CHUNK_SIZE = 50000
+
 TABLA_REGISTRO_CASOS = 'rn_registro_casos_transi'
 TABLA_DETALLE_CASOS = 'rn_detalle_casos_info_general'
 TABLA_PRESTACIONES_CASOS = 'rn_detalle_casos_prestaciones'
@@ -1,37 +1,104 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
 import pandas as pd
 import sqlalchemy
 
 import config.settings as settings
 
+@lru_cache(maxsize=None)
+def get_engine(db_uri: str = settings.POSTGRES_URI) -> sqlalchemy.engine.Engine:
+    # crea un único engine (y su pool de conexiones) por uri y lo reutiliza en las llamadas siguientes
+    return sqlalchemy.create_engine(
+        db_uri,
+        pool_size=settings.PG_POOL_SIZE,
+        max_overflow=settings.PG_MAX_OVERFLOW,
+        pool_pre_ping=True,
+        pool_recycle=settings.PG_POOL_RECYCLE,
+        future=True,
+    )
+
+def psql_insert_copy(table, conn, keys, data_iter):
+    # método para DataFrame.to_sql: carga las filas con COPY ... FROM STDIN en lugar de INSERTs
+    # arma de nuevo el DataFrame para que bulk_copy escriba los enteros con nulos como enteros
+    datos = pd.DataFrame(list(data_iter), columns=keys)
+    bulk_copy(datos, table.name, conn, esquema=table.schema)
+
+def enteros_con_nulos(datos: pd.DataFrame) -> pd.DataFrame:
+    # las columnas enteras con nulos llegan como float y to_csv las escribe como 123.0, que COPY rechaza en columnas enteras:
+    # las columnas float que solo tienen valores enteros se pasan a Int64 (se escriben como 123)
+    enteras = {}
+    for columna in datos.select_dtypes(include="float").columns:
+        valores = datos[columna].dropna()
+        if valores.abs().lt(2**63).all() and valores.mod(1).eq(0).all():
+            enteras[columna] = "Int64"
+    return datos.astype(enteras) if enteras else datos
+
+def bulk_copy(datos: pd.DataFrame, tabla: str, conn, esquema: str = None):
+    # carga un DataFrame en una tabla existente con COPY ... FROM STDIN, dentro de la transacción de conn
+    datos = enteros_con_nulos(datos)
+    buffer = io.StringIO()
+    datos.to_csv(buffer, index=False, header=False, na_rep=r'\N')
+    buffer.seek(0)
+
+    columnas = ", ".join(f'"{c}"' for c in datos.columns)
+    nombre_tabla = f'"{esquema}"."{tabla}"' if esquema else f'"{tabla}"'
+    with conn.connection.cursor() as cur:
+        cur.copy_expert(f"COPY {nombre_tabla} ({columnas}) FROM STDIN WITH (FORMAT CSV, NULL '\\N')", buffer)
+
+def copy_df_to_pg(datos: pd.DataFrame, tabla: str, engine: sqlalchemy.engine.Engine):
+    # reemplaza la tabla completa: DROP + CREATE según los tipos del DataFrame y carga con COPY, en una sola transacción
+    with engine.begin() as conn:
+        conn.execute(sqlalchemy.text(f'DROP TABLE IF EXISTS "{tabla}"'))
+        conn.execute(sqlalchemy.text(pd.io.sql.get_schema(datos, tabla, con=conn)))
+        # carga por bloques para acotar la memoria del buffer csv
+        for inicio in range(0, len(datos), settings.PG_COPY_CHUNK_SIZE):
+            bulk_copy(datos.iloc[inicio:inicio + settings.PG_COPY_CHUNK_SIZE], tabla, conn)
+
+def replace_tables(tablas: dict, engine: sqlalchemy.engine.Engine):
+    # carga cada DataFrame en paralelo como "<tabla>_new" (cada uno con su propia conexión del pool)
+    # y luego reemplaza todas las tablas en una sola transacción: las consultas nunca ven una tabla vacía o a medio cargar
+    with ThreadPoolExecutor(max_workers=len(tablas)) as executor:
+        futuros = [executor.submit(copy_df_to_pg, datos, f"{tabla}_new", engine) for tabla, datos in tablas.items()]
+        for futuro in futuros:
+            futuro.result()
+
+    with engine.begin() as conn:
+        for tabla in tablas:
+            conn.execute(sqlalchemy.text(f'DROP TABLE IF EXISTS "{tabla}"'))
+            conn.execute(sqlalchemy.text(f'ALTER TABLE "{tabla}_new" RENAME TO "{tabla}"'))
+
+def read_sql_stream(qry, engine: sqlalchemy.engine.Engine, params=None) -> pd.DataFrame:
+    # lee una consulta grande con un cursor del lado del servidor, por bloques, en lugar de traer todas las filas de una vez
+    with engine.connect().execution_options(stream_results=True, max_row_buffer=settings.PG_STREAM_CHUNK_SIZE) as conn:
+        bloques = list(pd.read_sql_query(qry, conn, params=params, chunksize=settings.PG_STREAM_CHUNK_SIZE))
+    if len(bloques) == 1:
+        return bloques[0]
+    return pd.concat(bloques, ignore_index=True) if bloques else pd.DataFrame()
+
 def revisar_ultima_actualizacion(cliente_id: str):
-    # establece la conexión a la base de datos
-    engine = sqlalchemy.create_engine(settings.POSTGRES_URI)
-    
-    # consulta para obtener la fecha de la última actualización
-    qry=f"""
-    SELECT fecha_registro
-    FROM {settings.TABLA_REGISTRO_CASOS}
-    WHERE cliente = '{cliente_id}'
-    ORDER BY fecha_registro DESC
-    LIMIT 1
-    """
-    df = pd.read_sql_query(qry, engine)
+    # obtiene la conexión compartida a la base de datos
+    engine = get_engine()
     
-    # obtiene los datos de la última actualización
-    fecha_registro = df['fecha_registro'].values[0]
-    qry=f"""
+    # obtiene los datos de la última actualización del cliente en una sola consulta
+    qry=sqlalchemy.text(f"""
     SELECT *
     FROM {settings.TABLA_REGISTRO_CASOS}
-    WHERE cliente = '{cliente_id}'
-    AND fecha_registro = '{fecha_registro}'
-    """
-    df = pd.read_sql_query(qry, engine)
+    WHERE cliente = :cliente_id
+    AND fecha_registro = (
+        SELECT MAX(fecha_registro)
+        FROM {settings.TABLA_REGISTRO_CASOS}
+        WHERE cliente = :cliente_id
+    )
+    """)
+    df = pd.read_sql_query(qry, engine, params={"cliente_id": cliente_id})
     
     return df
 
 def guardar_en_db(datos: pd.DataFrame, tabla: str):
-    # establece la conexión a la base de datos
-    engine = sqlalchemy.create_engine(settings.POSTGRES_URI)
+    # obtiene la conexión compartida a la base de datos
+    engine = get_engine()
 
     # guarda los datos en la base de datos
-    datos.to_sql(tabla, engine, if_exists='append', index=False)
\ No newline at end of file
+    datos.to_sql(tabla, engine, if_exists='append', index=False, method=psql_insert_copy)
\ No newline at end of file
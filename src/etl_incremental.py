@@ -1,4 +1,6 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime, timedelta
 from typing import Optional, List, Dict, Any
 import pandas as pd
@@ -6,6 +8,7 @@ import numpy as np
 import sqlalchemy
 from sqlalchemy import text
 import config.settings as settings
+from db_manager.db_manager import get_engine, psql_insert_copy, bulk_copy, read_sql_stream
 
 # Configure logging
 logging.basicConfig(
@@ -14,16 +17,134 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Indexes backing the hot queries (DISTINCT ON per folio, MAX(fecha_registro), "= ANY(:ids)" lookups).
+# fix_ETL rebuilds the datamarts by swapping in new tables, dropping the old ones, so run() recreates missing ones.
+INDEXES = {
+    "dm_rn_fechas_folio_padre": [
+        ("idx_fechas_folio_padre_last_state", "(cliente, folio_padre, fecha_registro DESC) INCLUDE (estado_padre)"),
+        ("idx_fechas_folio_padre_folio", "(folio_padre)"),
+        ("idx_fechas_folio_padre_fecha", "(fecha_registro)"),
+    ],
+    "dm_rn_fechas_folio_hijo": [
+        ("idx_fechas_folio_hijo_last_state", "(cliente, folio_hijo, fecha_registro DESC) INCLUDE (estado_hijo)"),
+        ("idx_fechas_folio_hijo_folio", "(folio_hijo)"),
+    ],
+    "rn_registro_casos_transi": [
+        ("idx_registro_casos_folio_padre", "(folio_padre, fecha_registro DESC)"),
+        ("idx_registro_casos_folio_hijo", "(folio_hijo, fecha_registro DESC)"),
+        ("idx_registro_casos_fecha", "(fecha_registro)"),
+        ("idx_registro_casos_cliente_fecha", "(cliente, fecha_registro)"),
+    ],
+}
+
+# Unique keys of the dimension tables, backing the upserts' ON CONFLICT (built by ensure_indexes)
+DIMENSION_KEYS = {
+    "dm_rn_folio_padre": ["cliente", "folio_padre"],
+    "dm_rn_folio_hijo": ["cliente", "folio_padre", "folio_hijo"],
+}
+
+# Max number of ids bound to a single "= ANY(:ids)" query
+MAX_IDS_PER_QUERY = 30000
+
 class IncrementalETL:
-    def __init__(self, db_uri: str):
+    # Columns of rn_registro_casos_transi used from the batch (history tables and change detection);
+    # the dimension refreshes read their own columns
+    REQUIRED_COLS = ["cliente", "folio_padre", "folio_hijo", "ppa_grd", "fecha_registro", "estado_padre", "estado_hijo"]
+
+    def __init__(self, db_uri: Optional[str] = None, engine: Optional[sqlalchemy.engine.Engine] = None):
         """
         Initialize the ETL process with database connection.
         
         Args:
-            db_uri: SQLAlchemy connection string for the database.
+            db_uri: SQLAlchemy connection string for the database. Ignored if engine is given.
+            engine: Shared (pooled) SQLAlchemy engine. Defaults to the process-wide engine for db_uri.
+        """
+        self.engine = engine if engine is not None else get_engine(db_uri or settings.POSTGRES_URI)
+        # First registration date per client, computed once per run
+        self._client_starts: Optional[pd.DataFrame] = None
+        
+    def begin(self, conn=None):
+        """
+        Context manager for a transaction: reuses conn if given (its owner commits), else begins a new one.
+        """
+        return nullcontext(conn) if conn is not None else self.engine.begin()
+
+    def ensure_indexes(self):
+        """
+        Create the indexes of INDEXES and the unique keys of DIMENSION_KEYS that are missing or invalid.
+        
+        Indexes are built with CREATE INDEX CONCURRENTLY (outside a transaction) so the
+        first build does not block writers; one left INVALID by an interrupted build is rebuilt.
+        A failure on INDEXES is logged and does not stop the run; a missing dimension key does,
+        since no upsert can succeed without it.
+        """
+        insp = sqlalchemy.inspect(self.engine)
+        with self.engine.connect() as conn:
+            conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+            for table_name, indexes in INDEXES.items():
+                if not insp.has_table(table_name):
+                    continue
+                for index_name, definition in indexes:
+                    try:
+                        if self.drop_invalid_index(conn, index_name):
+                            continue
+                        conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} ON {table_name} {definition}"))
+                    except Exception as e:
+                        logger.warning(f"Could not create index {index_name} on {table_name}: {e}")
+
+            for table_name, key_cols in DIMENSION_KEYS.items():
+                if insp.has_table(table_name):
+                    self.ensure_dimension_key(conn, table_name, key_cols)
+
+    def drop_invalid_index(self, conn, index_name: str) -> bool:
+        """
+        Drop an index left INVALID by an interrupted concurrent build, so it can be built again.
+        
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS would otherwise skip it forever.
+        
+        Args:
+            conn: Connection in AUTOCOMMIT mode.
+            index_name: Index to check.
+            
+        Returns:
+            True if a valid index with that name exists.
         """
-        self.engine = sqlalchemy.create_engine(db_uri)
+        is_valid = conn.execute(text("""
+        SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name
+        """), {"name": index_name}).scalar()
+        if is_valid is False:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}"))
+        return bool(is_valid)
+
+    def ensure_dimension_key(self, conn, table_name: str, key_cols: List[str]):
+        """
+        Build the unique key index of a dimension table if it is missing or invalid.
+        
+        Tables rebuilt by an older fix_ETL can hold duplicated keys; those are removed first,
+        keeping one row per key. Raises RuntimeError if the index still cannot be built.
         
+        Args:
+            conn: Connection in AUTOCOMMIT mode.
+            table_name: Dimension table.
+            key_cols: Columns of the unique key.
+        """
+        index_name = f"{table_name}_key_idx"
+        if self.drop_invalid_index(conn, index_name):
+            return
+
+        keys = ", ".join(key_cols)
+        key_match = " AND ".join(f"a.{c} = b.{c}" for c in key_cols)
+        deleted = conn.execute(text(f"DELETE FROM {table_name} a USING {table_name} b WHERE {key_match} AND a.ctid < b.ctid")).rowcount
+        if deleted:
+            logger.warning(f"Removed {deleted} rows with duplicated ({keys}) from {table_name}")
+
+        try:
+            conn.execute(text(f"CREATE UNIQUE INDEX CONCURRENTLY {index_name} ON {table_name} ({keys})"))
+        except Exception as e:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}"))
+            raise RuntimeError(f"Could not create unique index {index_name} on {table_name} ({keys}), "
+                               f"required by the dimension upsert: {e}") from e
+
     def get_max_date(self, table_name: str, date_column: str = "fecha_registro") -> Optional[datetime]:
         """
         Get the maximum date available in the destination table to determine the watermark.
@@ -62,27 +183,78 @@ class IncrementalETL:
         Returns:
             DataFrame with new records.
         """
-        base_query = "SELECT * FROM rn_registro_casos_transi"
+        # Only the required columns present in the table; missing ones are reported by run()
+        table_cols = {c["name"] for c in sqlalchemy.inspect(self.engine).get_columns("rn_registro_casos_transi")}
+        cols = ", ".join(c for c in self.REQUIRED_COLS if c in table_cols)
+        base_query = f"SELECT {cols} FROM rn_registro_casos_transi"
+        params = {}
         
         if start_date:
             # Add a small buffer or use > to avoid duplicates if possible, 
             # but given 'hourly' nature and potential concurrent writes, >= might be safer with dedup later
             # However, prompt asks for "datos incrementales".
-            
-            # Formating date for SQL
-            query = f"{base_query} WHERE fecha_registro > '{start_date}'"
+            query = f"{base_query} WHERE fecha_registro > :start_date"
+            params["start_date"] = start_date
         else:
             query = base_query
+        
+        # Date order lets process_status_changes shift states without sorting the batch
+        query = f"{query} ORDER BY fecha_registro"
             
-        logger.info(f"Executing extraction query: {query}")
+        logger.info(f"Executing extraction query: {query} {params}")
         try:
-            df = pd.read_sql_query(query, self.engine)
+            df = self.read_sql(query, params)
             logger.info(f"Extracted {len(df)} rows.")
             return df
         except Exception as e:
             logger.error(f"Error extracting data: {e}")
             raise
 
+    def read_sql(self, query: str, params: Optional[Dict[str, Any]] = None) -> pd.DataFrame:
+        """
+        Run a query streaming its result through a server-side cursor.
+        
+        Rows are fetched in chunks of settings.PG_STREAM_CHUNK_SIZE (see read_sql_stream)
+        instead of buffering the whole result set in the driver before building the DataFrame.
+        
+        Args:
+            query: SQL, with ":name" placeholders for params.
+            params: Bound parameters of the query.
+            
+        Returns:
+            DataFrame with the full result.
+        """
+        return read_sql_stream(text(query), self.engine, params)
+
+    def read_sql_by_ids(self, query: str, ids, param: str = "ids", **params) -> pd.DataFrame:
+        """
+        Run a query filtered by "= ANY(:param)", binding the ids as a Postgres array.
+        
+        The ids are sent in chunks of at most MAX_IDS_PER_QUERY, so the query must
+        return disjoint rows for disjoint sets of ids. Null ids are dropped: they never
+        match "= ANY" and would make psycopg2 bind a mixed text/float array.
+        
+        Args:
+            query: SQL with a ":param" array placeholder.
+            ids: Iterable of ids to bind.
+            param: Name of the array placeholder.
+            **params: Other bound parameters of the query.
+            
+        Returns:
+            DataFrame with the rows of every chunk.
+        """
+        ids = [i for i in ids if pd.notna(i)]
+        frames = []
+        for start in range(0, len(ids), MAX_IDS_PER_QUERY):
+            chunk_params = {**params, param: ids[start:start + MAX_IDS_PER_QUERY]}
+            frames.append(self.read_sql(query, chunk_params))
+        
+        if not frames:
+            return pd.DataFrame()
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames, ignore_index=True)
+
     def get_active_state_from_db(self, table_name: str, keys: List[str], state_col: str) -> pd.DataFrame:
         """
         Fetch the last known state for folios to calculate transitions correctly.
@@ -92,9 +264,13 @@ class IncrementalETL:
         # query logic to be implemented
         pass
 
-    def get_latest_state_from_db(self, table_name: str, group_cols: List[str], state_col: str) -> pd.DataFrame:
+    def get_latest_state_from_db(self, table_name: str, group_cols: List[str], state_col: str,
+                                 columns: Optional[List[str]] = None) -> pd.DataFrame:
         """
         Fetch the last known state for each group (client/folio) from the destination table.
+        
+        Args:
+            columns: Columns to fetch. Defaults to group_cols, state_col and fecha_registro.
         """
         try:
             # Check if table exists
@@ -104,92 +280,103 @@ class IncrementalETL:
 
             # Query to get the last row for each group
             # We use distinct on group_cols sorted by date desc
-            cols = ", ".join(group_cols + [state_col, "fecha_registro"])
+            cols = ", ".join(columns or group_cols + [state_col, "fecha_registro"])
             distinct_on = ", ".join(group_cols)
             
-            # Using Postgres DISTINCT ON to get the last record strictly
+            # Using Postgres DISTINCT ON to get the last record strictly.
+            # A "Folio suprimido" row shares its date with the folio's previous state and comes after it
             query = f"""
-            SELECT DISTINCT ON ({distinct_on}) *
+            SELECT DISTINCT ON ({distinct_on}) {cols}
             FROM {table_name}
-            ORDER BY {distinct_on}, fecha_registro DESC
+            ORDER BY {distinct_on}, fecha_registro DESC, ({state_col} IS NOT DISTINCT FROM 'Folio suprimido') DESC
             """
             
-            df = pd.read_sql_query(query, self.engine)
+            df = self.read_sql(query)
             return df
         except Exception as e:
             logger.error(f"Error fetching latest state from {table_name}: {e}")
             return pd.DataFrame()
 
-    def process_status_changes(self, df_new: pd.DataFrame, df_db_state: pd.DataFrame, 
-                             group_cols: List[str], state_col: str) -> pd.DataFrame:
-        """
-        Detect status changes by comparing new data with previous DB state.
+    def process_status_changes(self, df_new: pd.DataFrame, group_cols: List[str], state_col: str) -> pd.DataFrame:
         """
-        # Combine last DB state with new data
-        combined = pd.concat([df_db_state, df_new], ignore_index=True)
+        Detect status changes within a batch that has no history to compare against.
         
-        # Sort by group and date
-        combined = combined.sort_values(by=group_cols + ["fecha_registro"])
-        
-        # Filter rows where state changes
-        # Group by ID -> Shift state -> Compare
-        # We need to keep the row if it's the *first* time we see it in this batch (compared to DB) OR if it changes within the batch
-        
-        combined['prev_state'] = combined.groupby(group_cols)[state_col].shift()
-        
-        # Changes: where current state != prev state
-        # Note: The first row of 'df_new' for a group will compare against 'df_db_state' (if exists)
-        changes = combined[combined[state_col] != combined['prev_state']]
-        
-        # We only want to insert the rows that come from df_new
-        # The rows from df_db_state were just for comparison context
-        # So we filter based on index or by checking if the row is in df_new
-        # A safer way is to filter by fecha_registro > max(db_fecha) but we might process same timestamp data?
-        # Let's rely on the fact that we concat [db, new]. 
-        # Rows from db are at the top. 
-        # We can drop rows that are exactly equal to what we fetched from DB?
-        # Or simply: we only want to persist records that are physically in `df_new`.
-        
-        # Let's filter to keep only rows present in df_new (by index or key)
-        # But df_new might have multiple rows.
-        
-        # Simpler approach:
-        # The `changes` DF includes the rows that triggered a change.
-        # If a row came from `df_db_state`, it means the state changed *relative to valid start*. 
-        # Wait, if row is from DB, shift() is NaN (start). It appears in `changes` because NaN != State? 
-        # actually NaN != State is True.
-        # But we don't want to re-insert the DB row.
+        df_new must be ordered by fecha_registro (as returned by extract_new_data).
+        """
+        # Previous state of each row within the batch (df_new is in date order, so no sort is needed)
+        prev_state = df_new.groupby(group_cols, sort=False, observed=True)[state_col].shift(1).astype(object)
         
-        # Filter out rows that belong to the DB set
-        # We can use dates. "changes" must be from the new batch.
+        # Changes: where current state != prev state (the first row of each group is always a change)
+        return df_new[df_new[state_col].ne(prev_state)]
+
+    def detect_status_changes(self, df_new: pd.DataFrame, table_name: str,
+                              group_cols: List[str], state_col: str) -> pd.DataFrame:
+        """
+        Detect status changes of the new batch against the history table, inside Postgres.
         
-        # Get min date of new batch
-        min_new_date = df_new['fecha_registro'].min()
-        new_changes = changes[changes['fecha_registro'] >= min_new_date].copy()
+        df_new is COPYed into a temporary table and compared with LAG() against the last
+        known row of each of its groups, so the history never has to be loaded in pandas.
+        Falls back to process_status_changes when the history table does not exist yet.
         
-        return new_changes.drop(columns=['prev_state'])
+        Args:
+            df_new: New rows, with the same columns as the history table.
+            table_name: The target history table.
+            group_cols: Columns identifying a folio.
+            state_col: State column whose changes are tracked.
+            
+        Returns:
+            Rows of df_new where the state changed, in the same layout as process_status_changes.
+        """
+        if not sqlalchemy.inspect(self.engine).has_table(table_name):
+            return self.process_status_changes(df_new, group_cols, state_col)
+
+        cols = ", ".join(df_new.columns)
+        keys = ", ".join(group_cols)
+        
+        # The last known row of each group is ordered before the new rows with the same date;
+        # on a date tie the "Folio suprimido" row is the last one (it is dated with the previous state)
+        query = text(f"""
+        WITH last_state AS (
+            SELECT DISTINCT ON ({keys}) {cols}
+            FROM {table_name}
+            WHERE ({keys}) IN (SELECT {keys} FROM tmp_new)
+            ORDER BY {keys}, fecha_registro DESC, ({state_col} IS NOT DISTINCT FROM 'Folio suprimido') DESC
+        ),
+        combined AS (
+            SELECT {cols}, FALSE AS is_new FROM last_state
+            UNION ALL
+            SELECT {cols}, TRUE AS is_new FROM tmp_new
+        ),
+        with_prev AS (
+            SELECT *, LAG({state_col}) OVER (PARTITION BY {keys} ORDER BY fecha_registro, is_new) AS prev_state
+            FROM combined
+        )
+        SELECT {cols}
+        FROM with_prev
+        WHERE is_new AND {state_col} IS DISTINCT FROM prev_state
+        ORDER BY {keys}, fecha_registro
+        """)
+        
+        with self.engine.begin() as conn:
+            conn.execute(text(f"CREATE TEMP TABLE tmp_new (LIKE {table_name}) ON COMMIT DROP"))
+            bulk_copy(df_new, "tmp_new", conn)
+            return pd.read_sql_query(query, conn)
 
     def detect_suprimidos(self, df_batch_snapshot: pd.DataFrame, 
-                         table_name: str, group_cols: List[str], state_col: str) -> pd.DataFrame:
+                         table_name: str, group_cols: List[str], state_col: str,
+                         current_db_state: Optional[pd.DataFrame] = None) -> pd.DataFrame:
         """
         Detect items that are missing in the current snapshot but were active in DB.
         
         Args:
             df_batch_snapshot: The latest snapshot of active cases.
             table_name: The target history table.
+            current_db_state: Last known state per group, if already fetched with get_latest_state_from_db.
         """
         # 1. Get currently currently active items from DB (last known state is not 'Finished'/'Suprimido')
         # Ideally, we query unique IDs where last state != 'Folio suprimido'
-        
-        cols = ", ".join(group_cols + [state_col, "fecha_registro"])
-        distinct_on = ", ".join(group_cols)
-        
-        query = f"""
-        SELECT DISTINCT ON ({distinct_on}) *
-        FROM {table_name}
-        ORDER BY {distinct_on}, fecha_registro DESC
-        """
-        current_db_state = pd.read_sql_query(query, self.engine)
+        if current_db_state is None:
+            current_db_state = self.get_latest_state_from_db(table_name, group_cols, state_col)
         
         if current_db_state.empty:
             return pd.DataFrame()
@@ -199,15 +386,12 @@ class IncrementalETL:
         
         # 2. Identify missing
         # Create a set of keys
-        # We merge active_db with df_batch_snapshot on ID. 
-        # Those present in active_db but NOT in snapshot are "Suprimidos".
-        
-        merged = pd.merge(active_db[group_cols + [state_col]], 
-                          df_batch_snapshot[group_cols].assign(present=1), 
-                          on=group_cols, 
-                          how='left')
+        # Those present in active_db but NOT in snapshot are "Suprimidos" (set difference on the key index,
+        # no joined frame is materialized)
+        db_keys = pd.MultiIndex.from_frame(active_db[group_cols])
+        snapshot_keys = pd.MultiIndex.from_frame(df_batch_snapshot[group_cols])
         
-        missing = merged[merged['present'].isnull()].copy()
+        missing = active_db.loc[~db_keys.isin(snapshot_keys), group_cols + [state_col]].copy()
         
         if missing.empty:
             return pd.DataFrame()
@@ -219,52 +403,126 @@ class IncrementalETL:
         missing[state_col] = "Folio suprimido"
         missing['fecha_registro'] = snapshot_date
         
-        # Remove 'present' column
-        missing = missing.drop(columns=['present'])
-        
-        return missing
+        return missing.reset_index(drop=True)
 
     def get_static_client_start_dates(self) -> pd.DataFrame:
         """
         Get the first registration date for each client to determine Legacy vs Current.
+        
+        The full scan of rn_registro_casos_transi runs once per run(); later calls reuse it.
+        """
+        if self._client_starts is None:
+            query = "SELECT cliente, MIN(fecha_registro) as fecha_primer_registro FROM rn_registro_casos_transi GROUP BY cliente"
+            self._client_starts = pd.read_sql_query(query, self.engine)
+        return self._client_starts
+
+    def upsert_dimension(self, conn, df: pd.DataFrame, table_name: str, key_cols: List[str],
+                         scope_col: str, scope_values: List[str]):
+        """
+        Upsert rows into a dimension table with a single set-based statement.
+        
+        The rows are COPYed into a temporary staging table and merged with INSERT ... ON CONFLICT.
+        Rows of the target in the refreshed scope that are no longer produced are deleted
+        by the same statement, so readers never see a folio missing.
+        
+        Args:
+            conn: Connection with an open transaction.
+            df: Rows to persist.
+            table_name: Target dimension table.
+            key_cols: Columns identifying a row of the dimension.
+            scope_col: Column the refresh is scoped by (e.g. folio_padre).
+            scope_values: Values of scope_col being refreshed.
         """
-        query = "SELECT cliente, MIN(fecha_registro) as fecha_primer_registro FROM rn_registro_casos_transi GROUP BY cliente"
-        return pd.read_sql_query(query, self.engine)
+        if not sqlalchemy.inspect(conn).has_table(table_name):
+            df.to_sql(table_name, conn, if_exists="append", index=False, method=psql_insert_copy)
+            return
+
+        # ON CONFLICT relies on the unique key index built by ensure_indexes (see DIMENSION_KEYS)
+        keys = ", ".join(key_cols)
+        staging = f"stg_{table_name}"
+        conn.execute(text(f"CREATE TEMP TABLE {staging} (LIKE {table_name}) ON COMMIT DROP"))
+        bulk_copy(df, staging, conn)
+
+        cols = ", ".join(df.columns)
+        updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in df.columns if c not in key_cols)
+        on_conflict = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+        key_match = " AND ".join(f"s.{c} = t.{c}" for c in key_cols)
+        query = text(f"""
+        WITH stale AS (
+            DELETE FROM {table_name} t
+            WHERE t.{scope_col} = ANY(:scope)
+            AND NOT EXISTS (SELECT 1 FROM {staging} s WHERE {key_match})
+        )
+        INSERT INTO {table_name} ({cols})
+        SELECT {cols} FROM {staging}
+        ON CONFLICT ({keys}) {on_conflict}
+        """)
+        conn.execute(query, {"scope": [v for v in scope_values if pd.notna(v)]})
 
-    def update_dimensions_padre(self, df_new_folios: List[str]):
+    def update_dimensions_padre(self, df_new_folios: List[str], conn=None,
+                                df_new_history: Optional[pd.DataFrame] = None):
         """
         Update the dimension table for the specific folios affected by the new batch.
+        
+        Args:
+            df_new_folios: Folios padre to refresh.
+            conn: Open transaction to upsert in (e.g. the one that appended the history).
+            df_new_history: History rows appended in conn and not yet committed,
+                so not visible to the concurrent reads.
         """
         if not df_new_folios:
             return
 
         logger.info(f"Updating Dimensions Padre for {len(df_new_folios)} folios...")
         
-        # 1. Fetch History for these folios (from the OPTIMIZED history table)
-        placeholders = ",".join([f"'{f}'" for f in df_new_folios])
+        # 1. History for these folios (from the OPTIMIZED history table)
+        query_history = "SELECT cliente, folio_padre, fecha_registro, estado_padre FROM dm_rn_fechas_folio_padre WHERE folio_padre = ANY(:ids)"
+        
+        # 2. Static Info (from raw table, latest state), excluding url_ficha "codificado"
+        query_static = """
+        SELECT * FROM (
+            SELECT DISTINCT ON (cliente, folio_padre) 
+                cliente, folio_padre, fecha_asignacion, rut_paciente, nombre_paciente, intervencion_sanitaria, url_ficha 
+            FROM rn_registro_casos_transi 
+            WHERE folio_padre = ANY(:ids)
+            ORDER BY cliente, folio_padre, fecha_registro DESC
+        ) latest
+        WHERE url_ficha IS NULL OR url_ficha NOT LIKE '%codificado%'
+        """
+        
+        # 4. Extra info (Details), for every url_ficha of these folios
+        query_details = """
+        SELECT DISTINCT ON (url_ficha) url_ficha, fecha_atencion, intervencion_sanitaria_ingreso, problema_salud 
+        FROM rn_detalle_casos_info_general 
+        WHERE url_ficha IN (SELECT url_ficha FROM rn_registro_casos_transi WHERE folio_padre = ANY(:ids))
+        """
+        
+        # On a first run the history table is created in conn, so it does not exist yet for the concurrent reads
+        has_history = sqlalchemy.inspect(self.engine).has_table("dm_rn_fechas_folio_padre")
+        
+        # The reads are independent: run them concurrently, each on its own pooled connection
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            future_history = executor.submit(self.read_sql_by_ids, query_history, df_new_folios) if has_history else None
+            future_static = executor.submit(self.read_sql_by_ids, query_static, df_new_folios)
+            future_client_starts = executor.submit(self.get_static_client_start_dates)
+            future_details = executor.submit(self.read_sql_by_ids, query_details, df_new_folios)
+        
         try:
-            query_history = f"SELECT * FROM dm_rn_fechas_folio_padre WHERE folio_padre IN ({placeholders})"
-            df_history = pd.read_sql_query(query_history, self.engine)
-            if df_history.empty:
-                return
+            df_history = future_history.result() if future_history is not None else pd.DataFrame()
         except Exception as e:
             logger.error(f"Error reading history for padre: {e}")
             return
+        if df_new_history is not None and not df_new_history.empty:
+            df_new_rows = df_new_history[df_new_history["folio_padre"].isin(df_new_folios)]
+            df_history = pd.concat([df_history, df_new_rows], ignore_index=True) if not df_history.empty else df_new_rows
+        if df_history.empty:
+            return
 
-        # 2. Fetch Static Info (from raw table, latest state)
         try:
-            query_static = f"""
-            SELECT DISTINCT ON (cliente, folio_padre) 
-                cliente, folio_padre, fecha_asignacion, rut_paciente, nombre_paciente, intervencion_sanitaria, url_ficha 
-            FROM rn_registro_casos_transi 
-            WHERE folio_padre IN ({placeholders})
-            ORDER BY cliente, folio_padre, fecha_registro DESC
-            """
-            df_static = pd.read_sql_query(query_static, self.engine)
+            df_static = future_static.result()
             if df_static.empty:
                 return 
             
-            df_static = df_static[~df_static["url_ficha"].str.contains("codificado", na=False)]
             df_static["fecha_asignacion"] = pd.to_datetime(df_static["fecha_asignacion"])
         except Exception as e:
             logger.error(f"Error reading static info: {e}")
@@ -272,101 +530,71 @@ class IncrementalETL:
 
         # 3. Calculate "Acceptance Date" / Logic (Replica of fix_ETL)
         # Need client start dates
-        client_starts = self.get_static_client_start_dates()
+        client_starts = future_client_starts.result()
         
         # Merge start dates
         df_proc = pd.merge(df_static, client_starts, on="cliente", how="left")
         
-        # Split Current vs Legacy
-        df_current = df_proc[df_proc["fecha_asignacion"] >= df_proc["fecha_primer_registro"]].copy()
-        df_legacy = df_proc[df_proc["fecha_asignacion"] < df_proc["fecha_primer_registro"]].copy()
-        
-        # --- Logic for Current ---
-        if not df_current.empty:
-            df_current["tipo_seguimiento"] = "current"
-            hist_curr = df_history[df_history["folio_padre"].isin(df_current["folio_padre"])]
-            
-            non_accepted_states = ["Asignado", "Folio suprimido", "SIN Prestador", "Rechazo paciente sin consulta", "No acepta tratamiento"]
-            valid_states = hist_curr[~hist_curr["estado_padre"].isin(non_accepted_states)]
-            
-            if not valid_states.empty:
-                first_valid = valid_states.sort_values("fecha_registro").groupby(["cliente", "folio_padre"]).first().reset_index()
-                df_current = pd.merge(df_current, first_valid[["cliente", "folio_padre", "fecha_registro"]], on=["cliente", "folio_padre"], how="left")
-                df_current.rename(columns={"fecha_registro": "fecha_asignacion_aceptada"}, inplace=True)
-            else:
-                 df_current["fecha_asignacion_aceptada"] = None
-        
-        # --- Logic for Legacy ---
-        if not df_legacy.empty:
-            df_legacy["tipo_seguimiento"] = "legacy"
-            hist_leg = df_history[df_history["folio_padre"].isin(df_legacy["folio_padre"])]
-            
-            has_asignado = hist_leg[hist_leg["estado_padre"] == "Asignado"]["folio_padre"].unique()
-            
-            if not hist_leg.empty:
-                first_non_asignado = hist_leg[hist_leg["estado_padre"] != "Asignado"].sort_values("fecha_registro").groupby(["cliente", "folio_padre"]).first().reset_index()
-                df_legacy = pd.merge(df_legacy, first_non_asignado[["cliente", "folio_padre", "fecha_registro"]], on=["cliente", "folio_padre"], how="left")
-            else:
-                df_legacy["fecha_registro"] = None
-
-            # Apply condition
-            mask_identifiable = df_legacy["folio_padre"].isin(has_asignado)
-            # handle NaN dates carefully
-            df_legacy["fecha_asignacion_aceptada"] = np.where(mask_identifiable, df_legacy["fecha_registro"], df_legacy["fecha_asignacion"])
-            df_legacy.drop(columns=["fecha_registro"], inplace=True, errors='ignore')
-
-        # Combine
-        df_final = pd.concat([df_current, df_legacy], ignore_index=True)
+        # Flag Current vs Legacy in place (rows missing either date are neither and are left out)
+        is_current = df_proc["fecha_asignacion"] >= df_proc["fecha_primer_registro"]
+        is_legacy = df_proc["fecha_asignacion"] < df_proc["fecha_primer_registro"]
+        df_proc["tipo_seguimiento"] = np.where(is_current, "current", "legacy")
+        
+        # First accepted state (for current) and first non "Asignado" state (for legacy) per folio, in one table
+        non_accepted_states = ["Asignado", "Folio suprimido", "SIN Prestador", "Rechazo paciente sin consulta", "No acepta tratamiento"]
+        first_state = pd.DataFrame({
+            "fecha_primer_aceptado": df_history[~df_history["estado_padre"].isin(non_accepted_states)]
+                .groupby(["cliente", "folio_padre"], sort=False, observed=True)["fecha_registro"].min(),
+            "fecha_primer_no_asignado": df_history[df_history["estado_padre"] != "Asignado"]
+                .groupby(["cliente", "folio_padre"], sort=False, observed=True)["fecha_registro"].min(),
+        }).reset_index()
+        df_final = pd.merge(df_proc[is_current | is_legacy], first_state, on=["cliente", "folio_padre"], how="left")
+        
+        # Legacy folios are identifiable if they ever were "Asignado"; otherwise the assignment date is used
+        has_asignado = df_history.loc[df_history["estado_padre"] == "Asignado", "folio_padre"].unique()
+        df_final["fecha_asignacion_aceptada"] = np.where(
+            df_final["tipo_seguimiento"] == "current",
+            df_final["fecha_primer_aceptado"],
+            np.where(df_final["folio_padre"].isin(has_asignado), df_final["fecha_primer_no_asignado"], df_final["fecha_asignacion"]),
+        )
+        df_final.drop(columns=["fecha_primer_aceptado", "fecha_primer_no_asignado"], inplace=True)
         
         # 4. Add Extra info (Details)
         if not df_final.empty:
-            urls = df_final["url_ficha"].unique()
-            if len(urls) > 0:
-                urls_str = ",".join([f"'{u}'" for u in urls])
-                try:
-                    # Using limit/distinct on logic
-                    query_details = f"""
-                    SELECT DISTINCT ON (url_ficha) url_ficha, fecha_atencion, intervencion_sanitaria_ingreso, problema_salud 
-                    FROM rn_detalle_casos_info_general 
-                    WHERE url_ficha IN ({urls_str})
-                    """
-                    # Use a robust way to deduplicate if no explicit order column (or assume random is OK for static info)
-                    df_details = pd.read_sql_query(query_details, self.engine)
-                    # Deduplicate in pandas just in case SQL didn't
-                    df_details = df_details.drop_duplicates(subset=["url_ficha"], keep="last")
-                    
-                    df_final = pd.merge(df_final, df_details, on="url_ficha", how="left")
-                except Exception as e:
-                    logger.warning(f"Could not load info general: {e}")
+            try:
+                df_details = future_details.result()
+                # Deduplicate in pandas just in case SQL didn't (a url may come from several id chunks)
+                df_details = df_details.drop_duplicates(subset=["url_ficha"], keep="last")
+                
+                df_final = pd.merge(df_final, df_details, on="url_ficha", how="left")
+            except Exception as e:
+                logger.warning(f"Could not load info general: {e}")
 
             # 5. Add Latest State (from History)
-            last_state = df_history.sort_values("fecha_registro").groupby(["cliente", "folio_padre"]).last().reset_index()
-            last_state = last_state[["cliente", "folio_padre", "estado_padre", "fecha_registro"]]
+            last_idx = df_history.groupby(["cliente", "folio_padre"], sort=False, observed=True)["fecha_registro"].idxmax()
+            last_state = df_history.loc[last_idx, ["cliente", "folio_padre", "estado_padre", "fecha_registro"]]
             last_state.rename(columns={"estado_padre": "ultimo_estado_folio_padre", "fecha_registro": "fecha_ultimo_estado_folio_padre"}, inplace=True)
             
             df_final = pd.merge(df_final, last_state, on=["cliente", "folio_padre"], how="left")
             
             # 6. UPSERT into Postgres
-            # Delete existing rows
-            try:
-                with self.engine.connect() as conn:
-                    # chunk deletion if many?
-                    conn.execute(text(f"DELETE FROM dm_rn_folio_padre WHERE folio_padre IN ({placeholders})"))
-                    conn.commit()
-            except Exception as e:
-                logger.error(f"Error during delete: {e}")
-
-            # Insert new
             cols_to_drop = ["fecha_primer_registro"]
             df_final.drop(columns=[c for c in cols_to_drop if c in df_final.columns], inplace=True)
             
             logger.info(f"Upserting {len(df_final)} rows to dm_rn_folio_padre")
-            df_final.to_sql("dm_rn_folio_padre", self.engine, if_exists="append", index=False)
+            with self.begin(conn) as conn:
+                self.upsert_dimension(conn, df_final, "dm_rn_folio_padre", ["cliente", "folio_padre"],
+                                      "folio_padre", df_new_folios)
 
-    def update_dimensions_hijo(self, df_new_hijos: pd.DataFrame):
+    def update_dimensions_hijo(self, df_new_hijos: pd.DataFrame, conn=None,
+                               df_new_history: Optional[pd.DataFrame] = None):
         """
         Update dimension table for folio hijo. 
         df_new_hijos contains columns: cliente, folio_padre, folio_hijo
+        
+        Args:
+            conn: Open transaction to upsert in (e.g. the one that appended the history).
+            df_new_history: History rows appended in conn and not yet committed.
         """
         if df_new_hijos.empty:
             return
@@ -378,26 +606,30 @@ class IncrementalETL:
         if keys.empty:
             return
 
+        # Every folio hijo of the batch is refreshed: monto_total, url_ficha, prestaciones and
+        # tipo_seguimiento can change without a state change, so no watermark can skip one
+        folio_hijos = keys["folio_hijo"].dropna().unique().tolist()
+        if not folio_hijos:
+            return
+
         # 1. Fetch Static/Base Info
-        placeholders_hijo = ",".join([f"'{h}'" for h in keys["folio_hijo"]])
-        
         try:
-            query_base = f"""
+            query_base = """
             SELECT DISTINCT ON (cliente, folio_padre, folio_hijo) 
                 cliente, folio_padre, folio_hijo, intervencion_sanitaria, ppa_grd, monto_total, url_ficha 
             FROM rn_registro_casos_transi 
-            WHERE folio_hijo IN ({placeholders_hijo})
+            WHERE folio_hijo = ANY(:ids)
             ORDER BY cliente, folio_padre, folio_hijo, fecha_registro DESC
             """
-            df_base = pd.read_sql_query(query_base, self.engine)
+            df_base = self.read_sql_by_ids(query_base, folio_hijos)
         except Exception as e:
             logger.error(f"Error getting base hijo info: {e}")
             return
 
         # 2. Add Prestaciones Details
         try:
-             query_prest_simple = f"SELECT * FROM rn_detalle_casos_prestaciones WHERE folio IN ({placeholders_hijo})"
-             df_prest = pd.read_sql_query(query_prest_simple, self.engine)
+             query_prest_simple = "SELECT cliente, folio, descripcion, estado FROM rn_detalle_casos_prestaciones WHERE folio = ANY(:ids)"
+             df_prest = self.read_sql_by_ids(query_prest_simple, folio_hijos)
              if not df_prest.empty:
                  df_prest = df_prest.drop_duplicates(subset=["folio"], keep="last")
                  # Check cols
@@ -409,59 +641,80 @@ class IncrementalETL:
         except Exception as e:
             logger.warning(f"Could not load prestaciones details: {e}")
 
+        # Tables created by this run (e.g. the history, on a first run) are not visible to the reads until conn commits;
+        # they are read as empty so the dimension is still built with all its columns
+        insp = sqlalchemy.inspect(self.engine)
+
         # 3. Add Tipo Seguimiento (from Padre Dimension)
         if not df_base.empty:
-            folio_padres = keys["folio_padre"].unique()
+            # Suprimidos hijo rows carry no folio_padre
+            folio_padres = keys["folio_padre"].dropna().unique()
             if len(folio_padres) > 0:
-                placeholders_padre = ",".join([f"'{p}'" for p in folio_padres])
                 try:
-                    query_padre = f"SELECT cliente, folio_padre, tipo_seguimiento FROM dm_rn_folio_padre WHERE folio_padre IN ({placeholders_padre})"
-                    df_padre_info = pd.read_sql_query(query_padre, self.engine)
+                    query_padre = "SELECT cliente, folio_padre, tipo_seguimiento FROM dm_rn_folio_padre WHERE folio_padre = ANY(:ids)"
+                    if insp.has_table("dm_rn_folio_padre"):
+                        df_padre_info = self.read_sql_by_ids(query_padre, folio_padres)
+                    else:
+                        df_padre_info = pd.DataFrame(columns=["cliente", "folio_padre", "tipo_seguimiento"])
                     df_base = pd.merge(df_base, df_padre_info, on=["cliente", "folio_padre"], how="left")
-                except Exception:
-                    pass
+                except Exception as e:
+                    logger.warning(f"Could not load tipo_seguimiento from dm_rn_folio_padre: {e}")
 
         # 4. Add First/Last States from History (Hijo)
         try:
-            query_hist_hijo = f"SELECT * FROM dm_rn_fechas_folio_hijo WHERE folio_hijo IN ({placeholders_hijo})"
-            df_hist_hijo = pd.read_sql_query(query_hist_hijo, self.engine)
+            query_hist_hijo = "SELECT cliente, folio_padre, folio_hijo, estado_hijo, fecha_registro FROM dm_rn_fechas_folio_hijo WHERE folio_hijo = ANY(:ids)"
+            if insp.has_table("dm_rn_fechas_folio_hijo"):
+                df_hist_hijo = self.read_sql_by_ids(query_hist_hijo, folio_hijos)
+            else:
+                df_hist_hijo = pd.DataFrame()
+            if df_new_history is not None and not df_new_history.empty:
+                df_new_rows = df_new_history[df_new_history["folio_hijo"].isin(folio_hijos)]
+                df_hist_hijo = pd.concat([df_hist_hijo, df_new_rows], ignore_index=True) if not df_hist_hijo.empty else df_new_rows
             
             if not df_hist_hijo.empty:
+                hijo_keys = df_hist_hijo.groupby(["cliente", "folio_padre", "folio_hijo"], sort=False, observed=True)["fecha_registro"]
+                
                 # Last State
-                last = df_hist_hijo.sort_values("fecha_registro").groupby(["cliente", "folio_padre", "folio_hijo"]).last().reset_index()
-                last = last[["cliente", "folio_padre", "folio_hijo", "estado_hijo", "fecha_registro"]]
+                last = df_hist_hijo.loc[hijo_keys.idxmax(), ["cliente", "folio_padre", "folio_hijo", "estado_hijo", "fecha_registro"]]
                 last.rename(columns={"estado_hijo": "ultimo_estado_folio_hijo", "fecha_registro": "fecha_ultimo_estado_folio_hijo"}, inplace=True)
                 
                 # First State
-                first = df_hist_hijo.sort_values("fecha_registro").groupby(["cliente", "folio_padre", "folio_hijo"]).first().reset_index()
-                first = first[["cliente", "folio_padre", "folio_hijo", "estado_hijo", "fecha_registro"]]
+                first = df_hist_hijo.loc[hijo_keys.idxmin(), ["cliente", "folio_padre", "folio_hijo", "estado_hijo", "fecha_registro"]]
                 first.rename(columns={"estado_hijo": "primer_estado_folio_hijo", "fecha_registro": "fecha_primer_estado_folio_hijo"}, inplace=True)
                 
                 df_base = pd.merge(df_base, last, on=["cliente", "folio_padre", "folio_hijo"], how="left")
                 df_base = pd.merge(df_base, first, on=["cliente", "folio_padre", "folio_hijo"], how="left")
         except Exception as e:
+            # Re-raised so the dimension is never upserted (or created) without its state columns
             logger.error(f"Error reading hijo history: {e}")
+            raise
 
         # 5. Format GRD
+        # Code between the first and second ":" of the description, stripped and zero-padded,
+        # parsed with a single regex pass over the GRD rows only
         if "ppa_grd" in df_base.columns and "descripcion" in df_base.columns:
-            df_base["grd"] = np.where(df_base["ppa_grd"] == "GRD", 
-                                      df_base["descripcion"].str.split(":").str[1].str.strip().str.zfill(6), 
-                                      None)
+            is_grd = df_base["ppa_grd"].eq("GRD")
+            df_base["grd"] = None
+            df_base.loc[is_grd, "grd"] = (df_base.loc[is_grd, "descripcion"]
+                                          .str.extract(r"^[^:]*:\s*([^:]*?)\s*(?::|$)", expand=False)
+                                          .str.zfill(6))
 
         # 6. UPSERT
         try:
-            with self.engine.connect() as conn:
-                conn.execute(text(f"DELETE FROM dm_rn_folio_hijo WHERE folio_hijo IN ({placeholders_hijo})"))
-                conn.commit()
-                
             logger.info(f"Upserting {len(df_base)} rows to dm_rn_folio_hijo")
-            df_base.to_sql("dm_rn_folio_hijo", self.engine, if_exists="append", index=False)
+            with self.begin(conn) as conn:
+                self.upsert_dimension(conn, df_base, "dm_rn_folio_hijo", ["cliente", "folio_padre", "folio_hijo"],
+                                      "folio_hijo", folio_hijos)
         except Exception as e:
+            # Re-raised so the history appended in the same transaction is rolled back too
             logger.error(f"Error during upsert hijo: {e}")
+            raise
 
     def run(self):
         try:
             logger.info("Starting Incremental ETL Process...")
+            self._client_starts = None
+            self.ensure_indexes()
             
             # 1. Determine Watermark
             # We use dm_rn_fechas_folio_padre as the main tracker for "raw" updates history
@@ -480,32 +733,34 @@ class IncrementalETL:
             
             # 3. Process Folio Padre
             logger.info("Processing Folio Padre...")
-            df_state_padre = self.get_latest_state_from_db("dm_rn_fechas_folio_padre", ['cliente', 'folio_padre'], 'estado_padre')
-            
             padre_cols = ["cliente", "folio_padre", "fecha_registro", "estado_padre"]
             if all(col in df_new.columns for col in padre_cols):
-                df_changes_padre = self.process_status_changes(df_new[padre_cols], df_state_padre, ['cliente', 'folio_padre'], 'estado_padre')
+                df_changes_padre = self.detect_status_changes(df_new[padre_cols], "dm_rn_fechas_folio_padre", ['cliente', 'folio_padre'], 'estado_padre')
                 
                 # Detect Suprimidos
                 latest_ts = df_new['fecha_registro'].max()
                 latest_snapshot = df_new[df_new['fecha_registro'] == latest_ts]
                 
-                df_suprimidos_padre = self.detect_suprimidos(latest_snapshot, "dm_rn_fechas_folio_padre", ['cliente', 'folio_padre'], 'estado_padre')
+                df_state_padre = self.get_latest_state_from_db("dm_rn_fechas_folio_padre", ['cliente', 'folio_padre'], 'estado_padre',
+                                                               columns=padre_cols)
+                df_suprimidos_padre = self.detect_suprimidos(latest_snapshot, "dm_rn_fechas_folio_padre", ['cliente', 'folio_padre'], 'estado_padre',
+                                                             df_state_padre)
                 
                 if not df_suprimidos_padre.empty:
                     df_changes_padre = pd.concat([df_changes_padre, df_suprimidos_padre], ignore_index=True)
                 
-                # Persist Padre History
+                # Persist Padre History and Update Dimensions (single transaction, single COMMIT)
                 if not df_changes_padre.empty:
-                    logger.info(f"Appending {len(df_changes_padre)} rows to dm_rn_fechas_folio_padre")
-                    df_changes_padre.to_sql("dm_rn_fechas_folio_padre", self.engine, if_exists="append", index=False)
-                    
-                    # Update Dimensions
-                    affected_folios = df_new["folio_padre"].unique().tolist()
+                    affected_folios = pd.Index(df_new["folio_padre"])
                     if not df_suprimidos_padre.empty:
-                        affected_folios.extend(df_suprimidos_padre["folio_padre"].unique().tolist())
+                        affected_folios = affected_folios.append(pd.Index(df_suprimidos_padre["folio_padre"]))
+                    affected_folios = affected_folios.unique().tolist()
                     
-                    self.update_dimensions_padre(list(set(affected_folios)))
+                    with self.engine.begin() as conn:
+                        logger.info(f"Appending {len(df_changes_padre)} rows to dm_rn_fechas_folio_padre")
+                        df_changes_padre.to_sql("dm_rn_fechas_folio_padre", conn, if_exists="append", index=False, method=psql_insert_copy)
+                        
+                        self.update_dimensions_padre(affected_folios, conn, df_changes_padre)
             else:
                 logger.warning("Missing required columns for processing Folio Padre.")
             
@@ -520,31 +775,34 @@ class IncrementalETL:
                 df_hijo_raw = df_hijo_raw[~df_hijo_raw["folio_hijo"].isin(["", None])]
                 
                 if not df_hijo_raw.empty:
-                    df_state_hijo = self.get_latest_state_from_db("dm_rn_fechas_folio_hijo", ['cliente', 'folio_hijo'], 'estado_hijo')
-                    df_changes_hijo = self.process_status_changes(df_hijo_raw, df_state_hijo, ['cliente', 'folio_hijo'], 'estado_hijo')
+                    df_changes_hijo = self.detect_status_changes(df_hijo_raw, "dm_rn_fechas_folio_hijo", ['cliente', 'folio_hijo'], 'estado_hijo')
                     
                     # Suprimidos Hijo
+                    # The last known state is fetched once and reused to fill in the suprimidos
                     latest_snapshot_hijo = latest_snapshot[~latest_snapshot["folio_hijo"].isin(["", None])]
-                    df_suprimidos_hijo = self.detect_suprimidos(latest_snapshot_hijo, "dm_rn_fechas_folio_hijo", ['cliente', 'folio_hijo'], 'estado_hijo')
+                    df_state_hijo = self.get_latest_state_from_db("dm_rn_fechas_folio_hijo", ['cliente', 'folio_hijo'], 'estado_hijo',
+                                                                  columns=hijo_cols)
+                    df_suprimidos_hijo = self.detect_suprimidos(latest_snapshot_hijo, "dm_rn_fechas_folio_hijo", ['cliente', 'folio_hijo'], 'estado_hijo',
+                                                                df_state_hijo)
                     
                     if not df_suprimidos_hijo.empty:
-                        full_state = self.get_latest_state_from_db("dm_rn_fechas_folio_hijo", ['cliente', 'folio_hijo'], 'estado_hijo')
-                        if not full_state.empty:
-                            df_suprimidos_hijo_full = pd.merge(
-                                df_suprimidos_hijo[['cliente', 'folio_hijo', 'estado_hijo', 'fecha_registro']], 
-                                full_state[['cliente', 'folio_hijo', 'folio_padre', 'ppa_grd', 'estado_padre']], 
-                                on=['cliente', 'folio_hijo'], 
-                                how='left'
-                            )
-                            df_changes_hijo = pd.concat([df_changes_hijo, df_suprimidos_hijo_full], ignore_index=True)
+                        df_suprimidos_hijo_full = pd.merge(
+                            df_suprimidos_hijo[['cliente', 'folio_hijo', 'estado_hijo', 'fecha_registro']], 
+                            df_state_hijo[['cliente', 'folio_hijo', 'folio_padre', 'ppa_grd', 'estado_padre']], 
+                            on=['cliente', 'folio_hijo'], 
+                            how='left'
+                        )
+                        df_changes_hijo = pd.concat([df_changes_hijo, df_suprimidos_hijo_full], ignore_index=True)
 
                     if not df_changes_hijo.empty:
-                        logger.info(f"Appending {len(df_changes_hijo)} rows to dm_rn_fechas_folio_hijo")
-                        df_changes_hijo.to_sql("dm_rn_fechas_folio_hijo", self.engine, if_exists="append", index=False)
-                        
-                        # Update Dimensions Hijo
                         affected_hijos_df = pd.concat([df_hijo_raw, df_suprimidos_hijo], ignore_index=True) if not df_suprimidos_hijo.empty else df_hijo_raw
-                        self.update_dimensions_hijo(affected_hijos_df)
+                        
+                        # Persist Hijo History and Update Dimensions Hijo (single transaction, single COMMIT)
+                        with self.engine.begin() as conn:
+                            logger.info(f"Appending {len(df_changes_hijo)} rows to dm_rn_fechas_folio_hijo")
+                            df_changes_hijo.to_sql("dm_rn_fechas_folio_hijo", conn, if_exists="append", index=False, method=psql_insert_copy)
+                            
+                            self.update_dimensions_hijo(affected_hijos_df, conn, df_changes_hijo)
             else:
                 logger.warning("Missing required columns for processing Folio Hijo.")
 
@@ -555,5 +813,5 @@ class IncrementalETL:
             raise
 
 if __name__ == "__main__":
-    etl = IncrementalETL(settings.POSTGRES_URI)
+    etl = IncrementalETL(engine=get_engine())
     etl.run()
@@ -1,167 +1,239 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, timedelta
 
 import pandas as pd
 import numpy as np
 import sqlalchemy
 import config.settings as settings
+from db_manager.db_manager import get_engine, read_sql_stream, replace_tables
 
-engine = sqlalchemy.create_engine(settings.POSTGRES_URI)
+engine = get_engine(settings.POSTGRES_URI)
 
-qry = """
-SELECT * FROM rn_registro_casos_transi
+# solo las columnas que se usan para construir los datamarts
+qry_global = """
+SELECT cliente, folio_padre, folio_hijo, ppa_grd, fecha_registro, estado_padre, estado_hijo,
+       intervencion_sanitaria, url_ficha, monto_total
+FROM rn_registro_casos_transi
 """
-# Ahora el df_global ya viene con la lógica de folios suprimidos y cambios de estado
-df_global = pd.read_sql_query(qry, engine)
-
-print(df_global)
 
 # carga datos de registro de casos detalles: información general del caso
-tabla="rn_detalle_casos_info_general"
-qry=f"select * from {tabla}"
-df_info_general = pd.read_sql_query(qry, engine)
+# un registro por url_ficha, el último cargado (ctid DESC), deduplicado en la base de datos
+qry_info_general = """
+select distinct on (url_ficha) url_ficha, fecha_atencion, intervencion_sanitaria_ingreso, problema_salud
+from rn_detalle_casos_info_general
+order by url_ficha, ctid desc
+"""
 
-# carga datos de registro de casos detalles: información general del caso
-tabla="rn_detalle_casos_prestaciones"
-qry=f"select * from {tabla}"
-df_prestaciones = pd.read_sql_query(qry, engine)
+# carga datos de registro de casos detalles: prestaciones del caso
+# un registro por folio, el último cargado (ctid DESC), deduplicado en la base de datos
+qry_prestaciones = """
+select distinct on (folio) cliente, folio, descripcion, estado
+from rn_detalle_casos_prestaciones
+order by folio, ctid desc
+"""
+
+# datos del Folio Padre: excluye los registros con url_ficha que contienen "codificado" y deja un registro por (cliente, folio_padre), filtrando en la base de datos
+qry_folio_padre = sqlalchemy.text("""
+SELECT DISTINCT ON (cliente, folio_padre)
+    cliente, folio_padre, fecha_asignacion, rut_paciente, nombre_paciente, intervencion_sanitaria, url_ficha
+FROM rn_registro_casos_transi
+WHERE url_ficha IS NULL OR url_ficha NOT LIKE '%codificado%'
+ORDER BY cliente, folio_padre, ctid
+""")
+
+# fecha de aceptación de los folios current: la del primer registro con un estado posterior a "Asignado" (estados de asignación) y que no sea de rechazo,
+# calculada en la base de datos (el primer registro en uno de esos estados siempre es un cambio de estado)
+qry_primer_estado_aceptado = """
+SELECT cliente, folio_padre, MIN(fecha_registro) AS fecha_asignacion_aceptada
+FROM rn_registro_casos_transi
+WHERE estado_padre IS NULL
+   OR estado_padre NOT IN ('Asignado', 'Folio suprimido', 'SIN Prestador', 'Rechazo paciente sin consulta', 'No acepta tratamiento')
+GROUP BY cliente, folio_padre
+"""
+
+# las lecturas son independientes: se ejecutan en paralelo, cada una con su propia conexión del pool
+# el registro de casos es la tabla grande: se lee por bloques con un cursor del lado del servidor
+with ThreadPoolExecutor(max_workers=5) as executor:
+    futuro_global = executor.submit(read_sql_stream, qry_global, engine)
+    futuro_info_general = executor.submit(pd.read_sql_query, qry_info_general, engine)
+    futuro_prestaciones = executor.submit(pd.read_sql_query, qry_prestaciones, engine)
+    futuro_folio_padre = executor.submit(pd.read_sql_query, qry_folio_padre, engine)
+    futuro_primer_estado_aceptado = executor.submit(pd.read_sql_query, qry_primer_estado_aceptado, engine)
+
+    # Ahora el df_global ya viene con la lógica de folios suprimidos y cambios de estado
+    df_global = futuro_global.result()
+    df_info_general = futuro_info_general.result()
+    df_prestaciones = futuro_prestaciones.result()
+    dm_rn_folio_padre = futuro_folio_padre.result()
+    df_primer_estado_aceptado = futuro_primer_estado_aceptado.result()
+
+# cliente, tipo (ppa_grd) y estados tienen pocos valores distintos: como categorías se comparan y agrupan por su código entero
+# (los folios son identificadores casi únicos, por lo que se mantienen como texto)
+columnas_categoricas = ["cliente","ppa_grd","estado_padre","estado_hijo"]
+df_global[columnas_categoricas] = df_global[columnas_categoricas].astype("category")
+
+print(df_global)
 
 
 ### Construye tabla: Fecha Folio Padre
-# ordena folios por cliente y fecha de registro
-dm_rn_fechas_folio_padre= df_global[["cliente","folio_padre","fecha_registro","estado_padre"]].sort_values(by=["cliente","fecha_registro"])
+# ordena folios por cliente, folio y fecha de registro (un solo ordenamiento, reutilizado por los pasos siguientes)
+dm_rn_fechas_folio_padre= df_global[["cliente","folio_padre","fecha_registro","estado_padre"]].sort_values(by=["cliente","folio_padre","fecha_registro"], kind="stable")
 # # elimina duplicados por cliente, folio_padre y estado_padre (solo queda un estado por folio con la fecha de la primera aparición)
 # dm_rn_fechas_folio_padre=dm_rn_fechas_folio_padre.drop_duplicates(subset=["cliente","folio_padre","estado_padre"],keep="first").reset_index(drop=True).sort_values(by=["cliente","folio_padre","fecha_registro"])
-dm_rn_fechas_folio_padre=dm_rn_fechas_folio_padre.sort_values(by=["cliente","folio_padre","fecha_registro"])
-
 # Filtra solo cuando cambia estado_padre dentro de cada (cliente, folio_padre)
-dm_rn_fechas_folio_padre = dm_rn_fechas_folio_padre[
-    dm_rn_fechas_folio_padre.groupby(['cliente', 'folio_padre'])['estado_padre']
-    .shift() != dm_rn_fechas_folio_padre['estado_padre']
-].reset_index(drop=True)
+# compara los códigos de la categoría; el primer registro de cada folio recibe -2, que no es un código válido (los nulos son -1)
+codigos_estado = dm_rn_fechas_folio_padre['estado_padre'].cat.codes
+codigos_estado_previo = codigos_estado.groupby([dm_rn_fechas_folio_padre['cliente'], dm_rn_fechas_folio_padre['folio_padre']], sort=False, observed=True).shift(fill_value=-2)
+dm_rn_fechas_folio_padre = dm_rn_fechas_folio_padre[codigos_estado_previo != codigos_estado]
 
 # agregar estado "Folio suprimido" para los folio que ya no están en la lista
-suprimidos_df = df_global.groupby(['cliente', 'folio_padre'])['fecha_registro'].agg(['max']).reset_index().rename(columns={'max':'fecha_registro'})
+# fecha del último registro de cada folio hijo en una sola pasada sobre df_global (se reutiliza para los folios hijo);
+# la de cada folio padre se agrega desde ese resultado (incluye los registros sin folio hijo)
+# (agrupado con orden: el drop_duplicates de los folios hijo conserva el primer folio_padre según ese orden)
+ultimo_registro_folio_hijo = df_global.groupby(['cliente', 'folio_padre', 'folio_hijo'], observed=True, dropna=False)['fecha_registro'].max()
+suprimidos_df = ultimo_registro_folio_hijo.groupby(level=['cliente', 'folio_padre'], observed=True).max().reset_index()
 fecha_hoy=date.today()-timedelta(days=0) # la referencia debe ser el día 18/11/2025
-suprimidos_df=suprimidos_df[suprimidos_df["fecha_registro"].dt.date != fecha_hoy].reset_index(drop=True)
+suprimidos_df=suprimidos_df[suprimidos_df["fecha_registro"].dt.date != fecha_hoy]
 suprimidos_df["estado_padre"]="Folio suprimido"
-suprimidos_df.drop_duplicates(subset=["cliente","folio_padre","estado_padre"],keep="first",inplace=True)
+suprimidos_df=suprimidos_df.drop_duplicates(subset=["cliente","folio_padre","estado_padre"],keep="first")
 
 # agregar folios con estado "Folio suprimido"
-dm_rn_fechas_folio_padre=pd.concat([dm_rn_fechas_folio_padre,suprimidos_df],ignore_index=True).sort_values(by=["cliente","folio_padre","fecha_registro"])
-
-dm_rn_fechas_folio_padre.to_sql("dm_rn_fechas_folio_padre", engine, if_exists="replace", index=False)
+# alinea las columnas antes de concatenar para que no se tenga que unir ni reordenar columnas
+suprimidos_df=suprimidos_df.reindex(columns=dm_rn_fechas_folio_padre.columns)
+# el ordenamiento estable deja cada "Folio suprimido" después de los registros de su folio con la misma fecha
+dm_rn_fechas_folio_padre=pd.concat([dm_rn_fechas_folio_padre,suprimidos_df],ignore_index=True).sort_values(by=["cliente","folio_padre","fecha_registro"], kind="stable")
 
 
 ### Construye tabla: Fecha Folio Hijo
-dm_rn_fechas_folio_hijo= df_global[["cliente","folio_padre","folio_hijo","ppa_grd","fecha_registro","estado_padre", "estado_hijo"]].sort_values(by=["cliente","fecha_registro"])
-dm_rn_fechas_folio_hijo=dm_rn_fechas_folio_hijo[~dm_rn_fechas_folio_hijo["folio_hijo"].isin(["", None])].sort_values(by=["cliente","folio_hijo","fecha_registro"])
+dm_rn_fechas_folio_hijo= df_global[["cliente","folio_padre","folio_hijo","ppa_grd","fecha_registro","estado_padre", "estado_hijo"]]
+dm_rn_fechas_folio_hijo=dm_rn_fechas_folio_hijo[~dm_rn_fechas_folio_hijo["folio_hijo"].isin(["", None])].sort_values(by=["cliente","folio_hijo","fecha_registro"], kind="stable")
 
-# Filtra solo cuando cambia estado_hijo dentro de cada (cliente, folio_hijo)
-dm_rn_fechas_folio_hijo = dm_rn_fechas_folio_hijo[
-    dm_rn_fechas_folio_hijo.groupby(['cliente', 'folio_hijo'])['estado_hijo']
-    .shift() != dm_rn_fechas_folio_hijo['estado_hijo']
-].reset_index(drop=True)
+# Filtra solo cuando cambia estado_hijo dentro de cada (cliente, folio_hijo), comparando los códigos de la categoría
+codigos_estado = dm_rn_fechas_folio_hijo['estado_hijo'].cat.codes
+codigos_estado_previo = codigos_estado.groupby([dm_rn_fechas_folio_hijo['cliente'], dm_rn_fechas_folio_hijo['folio_hijo']], sort=False, observed=True).shift(fill_value=-2)
+dm_rn_fechas_folio_hijo = dm_rn_fechas_folio_hijo[codigos_estado_previo != codigos_estado]
 
 # agregar estado "Folio suprimido" para los folio que ya no están en la lista
-suprimidos_df = df_global.groupby(['cliente', 'folio_padre', 'folio_hijo'])['fecha_registro'].agg(['max']).reset_index().rename(columns={'max':'fecha_registro'})
+suprimidos_df = ultimo_registro_folio_hijo.reset_index().dropna(subset=['cliente', 'folio_padre', 'folio_hijo'])
 
 fecha_hoy=date.today()-timedelta(days=0)
-suprimidos_df=suprimidos_df[suprimidos_df["fecha_registro"].dt.date != fecha_hoy].reset_index(drop=True)
+suprimidos_df=suprimidos_df[suprimidos_df["fecha_registro"].dt.date != fecha_hoy]
 suprimidos_df["estado_hijo"]="Folio suprimido"
-suprimidos_df.drop_duplicates(subset=["cliente","folio_hijo","estado_hijo"],keep="first",inplace=True)
+suprimidos_df=suprimidos_df.drop_duplicates(subset=["cliente","folio_hijo","estado_hijo"],keep="first")
 
-# agregar folios con estado "Folio suprimido"
-dm_rn_fechas_folio_hijo=pd.concat([dm_rn_fechas_folio_hijo,suprimidos_df],ignore_index=True).sort_values(by=["cliente","folio_padre","folio_hijo","fecha_registro"])
-
-# pasa las tablas a postgres
-dm_rn_fechas_folio_hijo.to_sql("dm_rn_fechas_folio_hijo", engine, if_exists="replace", index=False)
+# agregar folios con estado "Folio suprimido" (columnas alineadas antes de concatenar; ppa_grd y estado_padre quedan vacíos)
+suprimidos_df=suprimidos_df.reindex(columns=dm_rn_fechas_folio_hijo.columns)
+dm_rn_fechas_folio_hijo=pd.concat([dm_rn_fechas_folio_hijo,suprimidos_df],ignore_index=True).sort_values(by=["cliente","folio_padre","folio_hijo","fecha_registro"], kind="stable")
 
 ########################################################
 ### Construye tabla: Folio Padre
-dm_rn_folio_padre= df_global[["cliente","folio_padre","fecha_asignacion","rut_paciente","nombre_paciente","intervencion_sanitaria","url_ficha"]]
+# dm_rn_folio_padre se carga al inicio, ya filtrado y deduplicado en la base de datos
 dm_rn_folio_padre["fecha_asignacion"]=pd.to_datetime(dm_rn_folio_padre["fecha_asignacion"])
 
-# Excluye los registros con url_ficha que contienen "codificado"
-dm_rn_folio_padre=dm_rn_folio_padre[~dm_rn_folio_padre["url_ficha"].str.contains("codificado")].drop_duplicates(subset=["cliente","folio_padre"]).reset_index(drop=True)
-
 # Separa los registros entre los que fueron creados posterior a la fecha en que se inició el seguiemiento con el scraping (current) y los que fueron creados antes (legacy)
 # obtene la referencia de la primera fecha de registro para cada cliente
-primer_registro_cliente = df_global.groupby('cliente')['fecha_registro'].min().reset_index().rename(columns={'fecha_registro': 'fecha_primer_registro'})
+primer_registro_cliente = df_global.groupby('cliente', sort=False, observed=True)['fecha_registro'].min().reset_index().rename(columns={'fecha_registro': 'fecha_primer_registro'})
 
-dm_rn_folio_padre_current=dm_rn_folio_padre[(dm_rn_folio_padre.apply(lambda row: row["fecha_asignacion"] >= primer_registro_cliente.loc[primer_registro_cliente["cliente"] == row["cliente"], "fecha_primer_registro"].values[0], axis=1))].reset_index(drop=True)
+# agrega la fecha de referencia de cada cliente a sus folios y compara ambas columnas de forma vectorizada
+dm_rn_folio_padre=pd.merge(dm_rn_folio_padre, primer_registro_cliente, on="cliente", how="left")
+es_current=dm_rn_folio_padre["fecha_asignacion"] >= dm_rn_folio_padre["fecha_primer_registro"]
+# los folios sin fecha de asignación no quedan en ninguno de los dos grupos
+es_legacy=dm_rn_folio_padre["fecha_asignacion"] < dm_rn_folio_padre["fecha_primer_registro"]
+dm_rn_folio_padre=dm_rn_folio_padre.drop(columns=["fecha_primer_registro"])
+
+dm_rn_folio_padre_current=dm_rn_folio_padre[es_current]
 dm_rn_folio_padre_current["tipo_seguimiento"]="current"
 
+# índice por (cliente, folio_padre) compartido por las búsquedas de los estados legacy y del último estado de cada folio
+# dm_rn_fechas_folio_padre ya está ordenado por cliente, folio_padre y fecha_registro: el primer registro de cada folio es el de menor fecha
+fechas_folio_padre_idx=dm_rn_fechas_folio_padre.set_index(["cliente","folio_padre"])
+
 # asignación de fecha de aceptación para registros current: la fecha del primer estado disponible superior a "Asignado" (estados de asignación) y que no sea "Folio suprimido", "SIN Prestador", "Rechazo paciente sin consulta", "No acepta tratamiento" (estados de rechazo)
-dm_rn_fechas_folio_padre_primer_estado_current=dm_rn_fechas_folio_padre[(~dm_rn_fechas_folio_padre["estado_padre"].isin(["Asignado"])) & (~dm_rn_fechas_folio_padre["estado_padre"].isin(["Folio suprimido", "SIN Prestador", "Rechazo paciente sin consulta", "No acepta tratamiento"]))]
-dm_rn_fechas_folio_padre_primer_estado_current=dm_rn_fechas_folio_padre_primer_estado_current[(dm_rn_fechas_folio_padre_primer_estado_current["fecha_registro"]==dm_rn_fechas_folio_padre_primer_estado_current.groupby(['cliente', 'folio_padre'])['fecha_registro'].transform('min'))]
+# se carga al inicio, ya calculada en la base de datos
+dm_rn_fechas_folio_padre_primer_estado_current=df_primer_estado_aceptado.set_index(["cliente","folio_padre"])
 
 # asigna la fecha del primer estado disponible en los datos para cada folio padre como fecha de aceptación (utiliza estados posteriores a "Asignado")
-dm_rn_folio_padre_current=pd.merge(dm_rn_folio_padre_current, dm_rn_fechas_folio_padre_primer_estado_current[["cliente","folio_padre","fecha_registro"]], on=["cliente","folio_padre"], how="left")
-dm_rn_folio_padre_current.rename(columns={"fecha_registro":"fecha_asignacion_aceptada"}, inplace=True)
+dm_rn_folio_padre_current=dm_rn_folio_padre_current.join(dm_rn_fechas_folio_padre_primer_estado_current["fecha_asignacion_aceptada"], on=["cliente","folio_padre"])
 
 # asignación de fecha de aceptación para registros legacy:
-dm_rn_folio_padre_legacy=dm_rn_folio_padre[(dm_rn_folio_padre.apply(lambda row: row["fecha_asignacion"] < primer_registro_cliente.loc[primer_registro_cliente["cliente"] == row["cliente"], "fecha_primer_registro"].values[0], axis=1))].reset_index(drop=True)
+dm_rn_folio_padre_legacy=dm_rn_folio_padre[es_legacy]
 dm_rn_folio_padre_legacy["tipo_seguimiento"]="legacy"
 
 # proporción de códigos identificables: aquellos a los que se les pudo registrar un estado de "Asignado"
-dm_rn_fechas_folio_padre_legacy=dm_rn_fechas_folio_padre[dm_rn_fechas_folio_padre["folio_padre"].isin(dm_rn_folio_padre_legacy["folio_padre"])]
-folios_identificables_legacy=dm_rn_fechas_folio_padre_legacy[(dm_rn_fechas_folio_padre_legacy["estado_padre"]=="Asignado")][["cliente","folio_padre"]].drop_duplicates()
+dm_rn_fechas_folio_padre_legacy=fechas_folio_padre_idx[fechas_folio_padre_idx.index.get_level_values("folio_padre").isin(dm_rn_folio_padre_legacy["folio_padre"])]
+folios_identificables_legacy=dm_rn_fechas_folio_padre_legacy.index[(dm_rn_fechas_folio_padre_legacy["estado_padre"]=="Asignado").to_numpy()].unique()
 
-dm_rn_fechas_folio_padre_legacy_identificables=dm_rn_fechas_folio_padre_legacy[(dm_rn_fechas_folio_padre_legacy["cliente"].isin(folios_identificables_legacy["cliente"])) & (dm_rn_fechas_folio_padre_legacy["folio_padre"].isin(folios_identificables_legacy["folio_padre"]))]
+dm_rn_fechas_folio_padre_legacy_identificables=dm_rn_fechas_folio_padre_legacy[dm_rn_fechas_folio_padre_legacy.index.isin(folios_identificables_legacy)]
 
-dm_rn_fechas_folio_padre_legacy_identificables_primer_estado=dm_rn_fechas_folio_padre_legacy_identificables[(dm_rn_fechas_folio_padre_legacy_identificables["estado_padre"]!="Asignado") & (dm_rn_fechas_folio_padre_legacy_identificables["fecha_registro"]==dm_rn_fechas_folio_padre_legacy_identificables.groupby(['cliente', 'folio_padre'])['fecha_registro'].transform('min'))]
+# primer registro de cada folio (el de menor fecha), solo si su estado no es "Asignado"
+# en un empate de fechas (p. ej. "Asignado" y "Folio suprimido" de un folio con una sola carga) los estados distintos de "Asignado" van primero,
+# de modo que se toma la fecha mínima si en esa fecha hay algún estado que no sea "Asignado"
+dm_rn_fechas_folio_padre_legacy_identificables_primer_estado=dm_rn_fechas_folio_padre_legacy_identificables.assign(es_asignado=dm_rn_fechas_folio_padre_legacy_identificables["estado_padre"].eq("Asignado"))
+dm_rn_fechas_folio_padre_legacy_identificables_primer_estado=dm_rn_fechas_folio_padre_legacy_identificables_primer_estado.sort_values(by=["cliente","folio_padre","fecha_registro","es_asignado"], kind="stable")
+dm_rn_fechas_folio_padre_legacy_identificables_primer_estado=dm_rn_fechas_folio_padre_legacy_identificables_primer_estado.groupby(level=["cliente","folio_padre"], sort=False, observed=True).head(1)
+dm_rn_fechas_folio_padre_legacy_identificables_primer_estado=dm_rn_fechas_folio_padre_legacy_identificables_primer_estado[~dm_rn_fechas_folio_padre_legacy_identificables_primer_estado["es_asignado"]]
 
 # asigna la fecha del primer estado disponible en los datos para cada folio padre como fecha de aceptación (utiliza estados posteriores a "Asignado")
-dm_rn_folio_padre_legacy=pd.merge(dm_rn_folio_padre_legacy, dm_rn_fechas_folio_padre_legacy_identificables_primer_estado[["cliente","folio_padre","fecha_registro"]], on=["cliente","folio_padre"], how="left")
-dm_rn_folio_padre_legacy.rename(columns={"fecha_registro":"fecha_asignacion_aceptada"}, inplace=True)
+dm_rn_folio_padre_legacy=dm_rn_folio_padre_legacy.join(dm_rn_fechas_folio_padre_legacy_identificables_primer_estado["fecha_registro"].rename("fecha_asignacion_aceptada"), on=["cliente","folio_padre"])
 
 # para los que no se pudo identificar un estado de "Asignado", se asigna la fecha de asignación como fecha de aceptación
 # Para cada valor de "fecha_asignacion_aceptada" que está vacía, asigna el valor de "fecha_asignacion"
-dm_rn_folio_padre_legacy["fecha_asignacion_aceptada"] = dm_rn_folio_padre_legacy["fecha_asignacion_aceptada"].fillna(dm_rn_folio_padre_legacy["fecha_asignacion"])
+# (where sobre la máscara de vacíos: una sola selección entre ambas columnas ya alineadas)
+sin_fecha_aceptada = dm_rn_folio_padre_legacy["fecha_asignacion_aceptada"].isna()
+dm_rn_folio_padre_legacy["fecha_asignacion_aceptada"] = dm_rn_folio_padre_legacy["fecha_asignacion_aceptada"].where(~sin_fecha_aceptada, dm_rn_folio_padre_legacy["fecha_asignacion"])
 
 # fuciona los dataframes de current y legacy
 dm_rn_folio_padre_final=pd.concat([dm_rn_folio_padre_current, dm_rn_folio_padre_legacy], ignore_index=True)
 
 # carga datos complementarios que están dentro de la ficha del folio padre (info general)
-df_info_general_validos=df_info_general[["url_ficha","fecha_atencion","intervencion_sanitaria_ingreso","problema_salud"]].drop_duplicates(subset=["url_ficha"],keep="last")
-dm_rn_folio_padre_final_info_general=pd.merge(dm_rn_folio_padre_final, df_info_general_validos, on=["url_ficha"], how="left")
+# las tablas de búsqueda tienen una fila por llave: se indexan una vez y se unen contra el índice con join
+df_info_general_validos=df_info_general.set_index("url_ficha")
+dm_rn_folio_padre_final_info_general=dm_rn_folio_padre_final.join(df_info_general_validos, on="url_ficha")
 
 # Agrega dato del ultimo estado del Folio Padre
-ultimo_estado_folio_padre=dm_rn_fechas_folio_padre.sort_values(by=["cliente", "folio_padre","fecha_registro"]).drop_duplicates(subset=["cliente", "folio_padre"],keep="last")[["cliente", "folio_padre", "estado_padre","fecha_registro"]]
-dm_rn_folio_padre_final_info_general=pd.merge(dm_rn_folio_padre_final_info_general, ultimo_estado_folio_padre, on=["cliente", "folio_padre"], how="left")
-dm_rn_folio_padre_final_info_general.rename(columns={"estado_padre":"ultimo_estado_folio_padre", "fecha_registro":"fecha_ultimo_estado_folio_padre"}, inplace=True)
-
-# pasa la tabla a postgres
-dm_rn_folio_padre_final_info_general.to_sql("dm_rn_folio_padre", engine, if_exists="replace", index=False)
+ultimo_estado_folio_padre=fechas_folio_padre_idx.groupby(level=["cliente", "folio_padre"], sort=False, observed=True).tail(1)[["estado_padre","fecha_registro"]]
+dm_rn_folio_padre_final_info_general=dm_rn_folio_padre_final_info_general.join(ultimo_estado_folio_padre, on=["cliente", "folio_padre"])
+dm_rn_folio_padre_final_info_general=dm_rn_folio_padre_final_info_general.rename(columns={"estado_padre":"ultimo_estado_folio_padre", "fecha_registro":"fecha_ultimo_estado_folio_padre"})
 
 ########################################################
 ### Construye tabla: Folio Hijo
 dm_rn_folio_hijo=df_global[["cliente","folio_padre","folio_hijo","intervencion_sanitaria","ppa_grd","monto_total","url_ficha"]].drop_duplicates(subset=["cliente","folio_padre","folio_hijo"],keep="last")
-dm_rn_folio_hijo=dm_rn_folio_hijo[~dm_rn_folio_hijo["folio_hijo"].isin(["", None])].reset_index(drop=True)
+dm_rn_folio_hijo=dm_rn_folio_hijo[~dm_rn_folio_hijo["folio_hijo"].isin(["", None])]
 
 # agreaga la información de las fichas de casos
 # df_prestaciones_validos=df_prestaciones[["cliente","folio","descripcion","monto_prestacion","monto_at","estado"]].drop_duplicates(subset=["folio"],keep="last")
-df_prestaciones_validos=df_prestaciones[["cliente","folio","descripcion","estado"]].drop_duplicates(subset=["folio"],keep="last")
-df_prestaciones_validos.rename(columns={"estado":"estado_prestacion"}, inplace=True)
+df_prestaciones_validos=df_prestaciones.set_index(["cliente","folio"]).rename(columns={"estado":"estado_prestacion"})
 
-dm_rn_folio_hijo_prestaciones=pd.merge(dm_rn_folio_hijo, df_prestaciones_validos, left_on=["cliente","folio_hijo"], right_on=["cliente","folio"], how="left").drop(columns=["folio"])
-dm_rn_folio_hijo_prestaciones_tipo_seguimiento=pd.merge(dm_rn_folio_hijo_prestaciones,dm_rn_folio_padre_final_info_general[["cliente","folio_padre","tipo_seguimiento"]], on=["cliente","folio_padre"], how="left")
+dm_rn_folio_hijo_prestaciones=dm_rn_folio_hijo.join(df_prestaciones_validos, on=["cliente","folio_hijo"])
+dm_rn_folio_hijo_prestaciones_tipo_seguimiento=dm_rn_folio_hijo_prestaciones.join(dm_rn_folio_padre_final_info_general.set_index(["cliente","folio_padre"])["tipo_seguimiento"], on=["cliente","folio_padre"])
 
 # dm_rn_folio_hijo_prestaciones_tipo_seguimiento["monto_total"]=dm_rn_folio_hijo_prestaciones_tipo_seguimiento["monto_prestacion"]+dm_rn_folio_hijo_prestaciones_tipo_seguimiento["monto_at"]
 # dm_rn_folio_hijo_prestaciones_tipo_seguimiento=dm_rn_folio_hijo_prestaciones_tipo_seguimiento[['cliente', 'folio_padre', 'folio_hijo', 'intervencion_sanitaria','ppa_grd', 'descripcion', 'monto_prestacion', 'monto_at', 'monto_total', 'estado_prestacion', 'tipo_seguimiento', 'url_ficha']]
 
 # agrega información del ultimo estado del Folio Hijo
-ultimo_estado_folio_hijo=dm_rn_fechas_folio_hijo.sort_values(by=["cliente", "folio_padre","folio_hijo","fecha_registro"]).drop_duplicates(subset=["cliente", "folio_padre","folio_hijo"],keep="last")[["cliente", "folio_padre","folio_hijo", "estado_hijo","fecha_registro"]]
-dm_rn_folio_hijo_prestaciones_tipo_seguimiento=pd.merge(dm_rn_folio_hijo_prestaciones_tipo_seguimiento, ultimo_estado_folio_hijo, on=["cliente", "folio_padre","folio_hijo"], how="left")
-dm_rn_folio_hijo_prestaciones_tipo_seguimiento.rename(columns={"estado_hijo":"ultimo_estado_folio_hijo", "fecha_registro":"fecha_ultimo_estado_folio_hijo"}, inplace=True)
+# dm_rn_fechas_folio_hijo ya está ordenado por cliente, folio_padre, folio_hijo y fecha_registro
+ultimo_estado_folio_hijo=dm_rn_fechas_folio_hijo.drop_duplicates(subset=["cliente", "folio_padre","folio_hijo"],keep="last").set_index(["cliente", "folio_padre","folio_hijo"])[["estado_hijo","fecha_registro"]]
+dm_rn_folio_hijo_prestaciones_tipo_seguimiento=dm_rn_folio_hijo_prestaciones_tipo_seguimiento.join(ultimo_estado_folio_hijo, on=["cliente", "folio_padre","folio_hijo"])
+dm_rn_folio_hijo_prestaciones_tipo_seguimiento=dm_rn_folio_hijo_prestaciones_tipo_seguimiento.rename(columns={"estado_hijo":"ultimo_estado_folio_hijo", "fecha_registro":"fecha_ultimo_estado_folio_hijo"})
 
 # agrega información del primer estado del Folio Hijo
-primer_estado_folio_hijo=dm_rn_fechas_folio_hijo.sort_values(by=["cliente", "folio_padre","folio_hijo","fecha_registro"]).drop_duplicates(subset=["cliente", "folio_padre","folio_hijo"],keep="first")[["cliente", "folio_padre","folio_hijo", "estado_hijo","fecha_registro"]]
-dm_rn_folio_hijo_prestaciones_tipo_seguimiento=pd.merge(dm_rn_folio_hijo_prestaciones_tipo_seguimiento, primer_estado_folio_hijo, on=["cliente", "folio_padre","folio_hijo"], how="left")
-dm_rn_folio_hijo_prestaciones_tipo_seguimiento.rename(columns={"estado_hijo":"primer_estado_folio_hijo", "fecha_registro":"fecha_primer_estado_folio_hijo"}, inplace=True)
+primer_estado_folio_hijo=dm_rn_fechas_folio_hijo.drop_duplicates(subset=["cliente", "folio_padre","folio_hijo"],keep="first").set_index(["cliente", "folio_padre","folio_hijo"])[["estado_hijo","fecha_registro"]]
+dm_rn_folio_hijo_prestaciones_tipo_seguimiento=dm_rn_folio_hijo_prestaciones_tipo_seguimiento.join(primer_estado_folio_hijo, on=["cliente", "folio_padre","folio_hijo"])
+dm_rn_folio_hijo_prestaciones_tipo_seguimiento=dm_rn_folio_hijo_prestaciones_tipo_seguimiento.rename(columns={"estado_hijo":"primer_estado_folio_hijo", "fecha_registro":"fecha_primer_estado_folio_hijo"})
 
-# formatea grd
-dm_rn_folio_hijo_prestaciones_tipo_seguimiento["grd"]=np.where(dm_rn_folio_hijo_prestaciones_tipo_seguimiento["ppa_grd"]=="GRD", dm_rn_folio_hijo_prestaciones_tipo_seguimiento["descripcion"].str.split(":").str[1].str.strip().str.zfill(6), None)
+# formatea grd: código entre el primer y el segundo ":" de la descripción, sin espacios y completado con ceros,
+# en una sola pasada de regex y solo sobre las filas GRD
+es_grd=dm_rn_folio_hijo_prestaciones_tipo_seguimiento["ppa_grd"].eq("GRD")
+dm_rn_folio_hijo_prestaciones_tipo_seguimiento["grd"]=None
+dm_rn_folio_hijo_prestaciones_tipo_seguimiento.loc[es_grd, "grd"]=dm_rn_folio_hijo_prestaciones_tipo_seguimiento.loc[es_grd, "descripcion"].str.extract(r"^[^:]*:\s*([^:]*?)\s*(?::|$)", expand=False).str.zfill(6)
 
 # dm_rn_folio_hijo_prestaciones_tipo_seguimiento.to_parquet(r"E:\MedIQ\Respaldo\RightNow-FONASA\Dashboard\dm_rn_folio_hijo.parquet")
-dm_rn_folio_hijo_prestaciones_tipo_seguimiento.to_sql("dm_rn_folio_hijo", engine, if_exists="replace", index=False)
\ No newline at end of file
+
+########################################################
+# pasa las tablas a postgres: se cargan en paralelo como tablas "_new" y se reemplazan las cuatro juntas en una sola transacción
+replace_tables({
+    "dm_rn_fechas_folio_padre": dm_rn_fechas_folio_padre,
+    "dm_rn_fechas_folio_hijo": dm_rn_fechas_folio_hijo,
+    "dm_rn_folio_padre": dm_rn_folio_padre_final_info_general,
+    "dm_rn_folio_hijo": dm_rn_folio_hijo_prestaciones_tipo_seguimiento,
+}, engine)
\ No newline at end of file